@@ -1,4 +1,89 @@
-return function(meshData)
+local base64Values = {}
+for i, char in ipairs({ string.byte("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/", 1, -1) }) do
+  base64Values[char] = i - 1
+end
+
+local function decodeBase64(str)
+  local floor, byte = math.floor, string.byte
+  local bytes, n = {}, 0
+  for i = 1, #str, 4 do
+    local a, b, c, d = byte(str, i, i + 3)
+    b = base64Values[b]
+    n = n + 1
+    bytes[n] = base64Values[a] * 4 + floor(b / 16)
+    c = base64Values[c]
+    if c then
+      n = n + 1
+      bytes[n] = b % 16 * 16 + floor(c / 4)
+      d = base64Values[d]
+      if d then
+        n = n + 1
+        bytes[n] = c % 4 * 64 + d
+      end
+    end
+  end
+  return bytes
+end
+
+-- See packVertexData in the exporter for the layout
+local function unpackVertexData(packed, vertexCount, hasPalettes)
+  local bytes, pos = decodeBase64(packed), 1
+  local function varint()
+    local value, scale, b = 0, 1, nil
+    repeat
+      b = bytes[pos]
+      pos = pos + 1
+      value = value + b % 128 * scale
+      scale = scale * 128
+    until b < 128
+    return value
+  end
+  local vertexData = {}
+  for index = 1, vertexCount do
+    local loops = {}
+    for _ = 1, varint() do
+      local textureIndex, vertexIndices, previous = varint(), {}, 0
+      for i = 1, varint() do
+        previous = previous + varint()
+        vertexIndices[i] = previous
+      end
+      loops[textureIndex] = vertexIndices
+    end
+    local rest = {}
+    for i = 1, 3 do
+      local value = varint()
+      rest[i] = (value % 2 == 0 and value / 2 or -(value + 1) / 2) / 4096
+    end
+    if hasPalettes then
+      vertexData[index] = { loops = loops, rest = rest, palette = varint() }
+    else
+      local weights
+      local weightCount = varint()
+      if weightCount > 0 then
+        weights = {}
+        for _ = 1, weightCount do
+          local groupIndex = varint()
+          weights[groupIndex] = (bytes[pos] + bytes[pos + 1] * 256) / 65535
+          pos = pos + 2
+        end
+      end
+      vertexData[index] = { loops = loops, rest = rest, weights = weights }
+    end
+  end
+  return vertexData
+end
+
+-- options (all optional):
+--   vertexBudget: maximum vertices skinned per update. Leftover vertices are skinned in the next updates
+--   instructionBudget: stop skinning for this update once the event used this many instructions
+--   distanceRates: list of { distance, n }, sorted by distance. Within distance blocks of the camera, the mesh
+--     is only updated every n-th update. Further away than the last entry, the mesh is not updated at all
+--   cullOffscreen: skip updating while the avatar is off screen. Defaults to true
+--   screenMargin: how far past the screen edge the avatar still counts as on screen. Defaults to 0.5
+--   skinOnTick: skin the mesh on tick and blend between the last two ticks every frame. Defaults to false
+-- An update is a frame, or a tick with skinOnTick.
+return function(meshData, options)
+  options = options or {}
   if type(meshData) == "string" then
     local file, found = meshData, nil
     found, meshData = pcall(require, file)
@@ -9,81 +94,391 @@ return function(meshData)
       end
     end
   end
-  local modelName, vertexData, groupMap, textureMap =
-      meshData.modelName, meshData.vertexData, meshData.groupMap, meshData.textureMap
+  local modelName, vertexData, textureMap = meshData.modelName, meshData.vertexData, meshData.textureMap
+  if meshData.packedVertexData then
+    vertexData = unpackVertexData(meshData.packedVertexData, meshData.vertexCount, meshData.palettes ~= nil)
+  end
   local model = models[modelName]
-  local figuraVertices = model.Mesh:setVisible(true):getAllVertices()
-  local vertices = {}
-  local modelTextureFString = modelName .. ".%s"
-  for index, data in ipairs(vertexData) do
-    local vertex = {}
-    local vertexObjects = {}
-    for textureIndex, loopData in pairs(data.loops) do
-      local textureVertices = figuraVertices[modelTextureFString:format(textureMap[textureIndex])]
-      for _, vert in ipairs(loopData) do
-        table.insert(vertexObjects, textureVertices[vert])
-      end
-    end
-    vertex.verts = vertexObjects
-    if data.weights then
-      local groupSum = 0
-      for _, weight in pairs(data.weights) do
-        groupSum = groupSum + weight
-      end
-      local groupWeights = {}
-      for key, weight in pairs(data.weights) do
-        groupWeights[key] = 1 / groupSum * weight
-      end
-      vertex.groupWeights = groupWeights
-    end
-    vertex.pos = vertex.verts[1]:getPos()
-    vertices[index] = vertex
+
+  if not meshData.bones then
+    error(("MeshData %q is from an older exporter. Export the model again."):format(modelName), 2)
+  end
+
+  -- Bones are stored in dense arrays, parents before their children.
+  -- The 3x4 affine matrix of bone b lives in boneMatrices[b * 12 - 11 .. b * 12], row major.
+  local boneCount, boneParts, boneParents, groupBones = #meshData.bones, {}, {}, {}
+  for b, bone in ipairs(meshData.bones) do
+    local parentPart = bone.parent == 0 and model or boneParts[bone.parent]
+    local part = parentPart[bone.name]
+    if not part then
+      error(("Bone %q is missing from model %q."):format(bone.name, modelName), 2)
+    end
+    boneParts[b] = part:setParentType("None")
+    boneParents[b] = bone.parent
+    if bone.group then
+      groupBones[bone.group] = b
+    end
   end
 
-  local boneTree = {}
+  -- Vertex v has the influences influenceStarts[v] .. influenceStarts[v + 1] - 1,
+  -- and the figura vertices vertexRefStarts[v] .. vertexRefStarts[v + 1] - 1.
+  -- Bone b moves the vertices boneVertexList[boneVertexStarts[b] .. boneVertexStarts[b + 1] - 1].
+  -- influenceOffsets holds the offset of the bone's matrix in boneMatrices instead of the bone index.
+  -- With weight palettes, the influences belong to palette vertexPalettes[v] instead of the vertex, 0 for none.
+  local restX, restY, restZ = {}, {}, {}
+  local influenceStarts, influenceOffsets, influenceWeights = { 1 }, {}, {}
+  local vertexRefStarts, vertexRefs = { 1 }, {}
+  local palettes = meshData.palettes
+  local paletteCount, vertexPalettes = palettes and #palettes or 0, palettes and {}
+  local boneVertexStarts, boneVertexList = meshData.boneVertexStarts, meshData.boneVertexList
+  local boneVertices = {}
+  for groupIndex, list in pairs(meshData.boneVertices or {}) do
+    if groupBones[groupIndex] then
+      boneVertices[groupBones[groupIndex]] = list
+    end
+  end
   do
-    local function generateBoneTree(modelPart, parentIndex)
-      local groupIndex = groupMap[modelPart:getName()]
-      if groupIndex then
-        local a = {
-          parent = parentIndex,
-          index = groupIndex,
-          modelPart = modelPart:setParentType("None"),
-        }
-        table.insert(boneTree, a)
-        for _, child in ipairs(modelPart:getChildren()) do
-          if child:getType() == "GROUP" then
-            generateBoneTree(child, a.index)
+    local figuraVertices = model.Mesh:setVisible(true):getAllVertices()
+    local modelTextureFString = modelName .. ".%s"
+    local influenceCount, refCount = 0, 0
+    -- the exporter already left out groups without a bone and normalized the weights
+    local function addInfluences(weights)
+      for groupIndex, weight in pairs(weights) do
+        influenceCount = influenceCount + 1
+        influenceOffsets[influenceCount] = groupBones[groupIndex] * 12 - 12
+        influenceWeights[influenceCount] = weight
+      end
+    end
+    for p = 1, paletteCount do
+      addInfluences(palettes[p])
+      influenceStarts[p + 1] = influenceCount + 1
+    end
+    if meshData.vertexRefStarts then
+      -- Dense layout, already in the shape used below
+      local textureVertices = {}
+      for textureIndex, textureName in ipairs(textureMap) do
+        textureVertices[textureIndex] = figuraVertices[modelTextureFString:format(textureName)]
+      end
+      local refTextures, refVertices = meshData.refTextures, meshData.refVertices
+      vertexRefStarts = meshData.vertexRefStarts
+      for r = 1, #refTextures do
+        vertexRefs[r] = textureVertices[refTextures[r]][refVertices[r]]
+      end
+      local rest = meshData.restPositions
+      for v = 1, meshData.vertexCount do
+        restX[v], restY[v], restZ[v] = rest[v * 3 - 2], rest[v * 3 - 1], rest[v * 3]
+      end
+      if vertexPalettes then
+        vertexPalettes = meshData.vertexPalettes
+      else
+        local influenceBones = meshData.influenceBones
+        influenceStarts, influenceWeights = meshData.influenceStarts, meshData.influenceWeights
+        for k = 1, #influenceBones do
+          influenceOffsets[k] = influenceBones[k] * 12 - 12
+        end
+      end
+    else
+      for index, data in ipairs(vertexData) do
+        for textureIndex, loopData in pairs(data.loops) do
+          local textureVertices = figuraVertices[modelTextureFString:format(textureMap[textureIndex])]
+          for _, vert in ipairs(loopData) do
+            refCount = refCount + 1
+            vertexRefs[refCount] = textureVertices[vert]
+          end
+        end
+        vertexRefStarts[index + 1] = refCount + 1
+        if vertexPalettes then
+          vertexPalettes[index] = data.palette
+        else
+          if data.weights then
+            addInfluences(data.weights)
+          end
+          influenceStarts[index + 1] = influenceCount + 1
+        end
+        local rest = data.rest
+        restX[index], restY[index], restZ[index] = rest[1], rest[2], rest[3]
+      end
+    end
+
+    if not boneVertexStarts and not meshData.boneVertices then
+      for v = 1, #restX do
+        local i = vertexPalettes and vertexPalettes[v] or v
+        if i > 0 then
+          for k = influenceStarts[i], influenceStarts[i + 1] - 1 do
+            local b = influenceOffsets[k] / 12 + 1
+            local list = boneVertices[b]
+            if not list then
+              list = {}
+              boneVertices[b] = list
+            end
+            list[#list + 1] = v
           end
         end
       end
     end
-    for _, child in ipairs(model:getChildren()) do
-      if child:getType() == "GROUP" then
-        generateBoneTree(child)
+    if not boneVertexStarts then
+      boneVertexStarts, boneVertexList = { 1 }, {}
+      local count = 0
+      for b = 1, boneCount do
+        for _, v in ipairs(boneVertices[b] or {}) do
+          count = count + 1
+          boneVertexList[count] = v
+        end
+        boneVertexStarts[b + 1] = count + 1
       end
     end
   end
+
   do
-    local vec3 = vectors.vec3
-    local mat4 = matrices.mat4()
+    local abs = math.abs
+    local boneMatrices, localMatrices = {}, {}
+    -- The blended matrix of palette p, in paletteMatrices[p * 12 - 11 .. p * 12], is worked out
+    -- by the first vertex that needs it each frame and reused by the rest.
+    local paletteMatrices, paletteFrame = {}, {}
+    local movedBones, skinnedFrame, frame = { [0] = false }, {}, 0
+    for i = 1, boneCount * 12 do
+      localMatrices[i] = 0 / 0 -- NaN never equals anything, so every bone starts out moved
+      boneMatrices[i] = 0
+    end
+
+    -- Bones whose vertices still have to be skinned. Each is worked through from boneCursors[b],
+    -- so a frame that runs out of budget continues where it stopped on the next frame.
+    -- A bone that moves again halfway through starts over once it reaches the end.
+    local vertexBudget, instructionBudget = options.vertexBudget or math.huge, options.instructionBudget
+    local sliced = vertexBudget ~= math.huge or instructionBudget ~= nil
+    local pendingBones, pendingCount = {}, 0
+    local isPending, boneCursors, restartBones, pendingSince, boneMotion = {}, {}, {}, {}, {}
+    for b = 1, boneCount do
+      isPending[b], boneCursors[b], restartBones[b], boneMotion[b] = false, boneVertexStarts[b], false, 0
+    end
+    -- Bones that moved the most come first. Waiting bones slowly gain priority so they never starve
+    local function byPriority(a, b)
+      return boneMotion[a] * (frame - pendingSince[a] + 1) > boneMotion[b] * (frame - pendingSince[b] + 1)
+    end
+
+    -- Only applies to the world render. Paperdolls and menus always update.
+    -- Figura returns matrices and positions as new objects, so an update allocates one matrix per bone in
+    -- updateBones plus the vectors these checks read: the player position and its screen position with
+    -- cullOffscreen, and the player and camera position with distanceRates.
+    local distanceRates, cullOffscreen = options.distanceRates, options.cullOffscreen ~= false
+    local screenEdge = 1 + (options.screenMargin or 0.5)
+    local updateCount, centerHeight = 0, nil
+    local squaredDistances = {}
+    for i, rate in ipairs(distanceRates or {}) do
+      squaredDistances[i] = rate[1] * rate[1]
+    end
+    local function isVisible()
+      if not model:getVisible() then
+        return false
+      end
+      if cullOffscreen and not (host:isHost() and renderer:isFirstPerson()) then
+        centerHeight = centerHeight or player:getBoundingBox().y / 2
+        local screen = vectors.worldToScreenSpace(player:getPos():add(0, centerHeight, 0))
+        if screen.z <= 1 or abs(screen.x) > screenEdge or abs(screen.y) > screenEdge then
+          return false
+        end
+      end
+      return true
+    end
+    local function shouldUpdate()
+      if not isVisible() then
+        return false
+      end
+      if distanceRates then
+        updateCount = updateCount + 1
+        local playerPos, cameraPos = player:getPos(), client:getCameraPos()
+        local dx, dy, dz = cameraPos.x - playerPos.x, cameraPos.y - playerPos.y, cameraPos.z - playerPos.z
+        local squaredDistance = dx * dx + dy * dy + dz * dz
+        for i, rate in ipairs(distanceRates) do
+          if squaredDistance <= squaredDistances[i] then
+            return updateCount % rate[2] == 0
+          end
+        end
+        return false
+      end
+      return true
+    end
+
+    -- With skinOnTick, vertices are skinned into cur* on tick and moved between prev* and cur* every frame
+    local skinOnTick = options.skinOnTick
+    local prevX, prevY, prevZ, curX, curY, curZ = {}, {}, {}, {}, {}, {}
+    local ticked, tickedCount, settling = {}, 0, {}
+
+    local function updateBones()
+      local m, l = boneMatrices, localMatrices
+      for b = 1, boneCount do
+        local matrix = boneParts[b]:getPositionMatrix()
+        local a11, a12, a13, a14 = matrix.v11, matrix.v12, matrix.v13, matrix.v14
+        local a21, a22, a23, a24 = matrix.v21, matrix.v22, matrix.v23, matrix.v24
+        local a31, a32, a33, a34 = matrix.v31, matrix.v32, matrix.v33, matrix.v34
+        local o, parent = b * 12 - 12, boneParents[b]
+        if movedBones[parent]
+            or a11 ~= l[o + 1] or a12 ~= l[o + 2] or a13 ~= l[o + 3] or a14 ~= l[o + 4]
+            or a21 ~= l[o + 5] or a22 ~= l[o + 6] or a23 ~= l[o + 7] or a24 ~= l[o + 8]
+            or a31 ~= l[o + 9] or a32 ~= l[o + 10] or a33 ~= l[o + 11] or a34 ~= l[o + 12] then
+          l[o + 1], l[o + 2], l[o + 3], l[o + 4] = a11, a12, a13, a14
+          l[o + 5], l[o + 6], l[o + 7], l[o + 8] = a21, a22, a23, a24
+          l[o + 9], l[o + 10], l[o + 11], l[o + 12] = a31, a32, a33, a34
+          local p, motion = parent * 12 - 12, 0
+          for r = 0, 8, 4 do
+            local c1, c2, c3, c4
+            if parent == 0 then
+              c1, c2, c3, c4 = l[o + r + 1], l[o + r + 2], l[o + r + 3], l[o + r + 4]
+            else
+              local p1, p2, p3, p4 = m[p + r + 1], m[p + r + 2], m[p + r + 3], m[p + r + 4]
+              c1 = p1 * a11 + p2 * a21 + p3 * a31
+              c2 = p1 * a12 + p2 * a22 + p3 * a32
+              c3 = p1 * a13 + p2 * a23 + p3 * a33
+              c4 = p1 * a14 + p2 * a24 + p3 * a34 + p4
+            end
+            motion = motion + abs(c1 - m[o + r + 1]) + abs(c2 - m[o + r + 2])
+                + abs(c3 - m[o + r + 3]) + abs(c4 - m[o + r + 4])
+            m[o + r + 1], m[o + r + 2], m[o + r + 3], m[o + r + 4] = c1, c2, c3, c4
+          end
+          movedBones[b] = true
+          boneMotion[b] = boneMotion[b] + motion
+          if not isPending[b] then
+            isPending[b], pendingSince[b] = true, frame
+            pendingCount = pendingCount + 1
+            pendingBones[pendingCount] = b
+          elseif boneCursors[b] > boneVertexStarts[b] then
+            restartBones[b] = true
+          end
+        else
+          movedBones[b] = false
+        end
+      end
+    end
+
+    local function skinVertices()
+      local m = boneMatrices
+      if sliced and pendingCount > 1 then
+        table.sort(pendingBones, byPriority)
+      end
+      local skinned, outOfBudget, kept = 0, false, 0
+      for i = 1, pendingCount do
+        local b = pendingBones[i]
+        pendingBones[i] = nil
+        if not outOfBudget then
+          local cursor, last = boneCursors[b], boneVertexStarts[b + 1] - 1
+          while cursor <= last do
+            if skinned >= vertexBudget or (instructionBudget and skinned % 16 == 0
+                  and avatar:getCurrentInstructions() >= instructionBudget) then
+              outOfBudget = true
+              break
+            end
+            local v = boneVertexList[cursor]
+            cursor = cursor + 1
+            if skinnedFrame[v] ~= frame then
+              skinnedFrame[v] = frame
+              skinned = skinned + 1
+              local px, py, pz = restX[v], restY[v], restZ[v]
+              local x, y, z = 0, 0, 0
+              if vertexPalettes then
+                local p = vertexPalettes[v]
+                local q = p * 12 - 12
+                if paletteFrame[p] ~= frame then
+                  paletteFrame[p] = frame
+                  for i = q + 1, q + 12 do
+                    paletteMatrices[i] = 0
+                  end
+                  for k = influenceStarts[p], influenceStarts[p + 1] - 1 do
+                    local o, w = influenceOffsets[k], influenceWeights[k]
+                    for i = 1, 12 do
+                      paletteMatrices[q + i] = paletteMatrices[q + i] + w * m[o + i]
+                    end
+                  end
+                end
+                local n = paletteMatrices
+                x = n[q + 1] * px + n[q + 2] * py + n[q + 3] * pz + n[q + 4]
+                y = n[q + 5] * px + n[q + 6] * py + n[q + 7] * pz + n[q + 8]
+                z = n[q + 9] * px + n[q + 10] * py + n[q + 11] * pz + n[q + 12]
+              else
+                for k = influenceStarts[v], influenceStarts[v + 1] - 1 do
+                  local o, w = influenceOffsets[k], influenceWeights[k]
+                  x = x + w * (m[o + 1] * px + m[o + 2] * py + m[o + 3] * pz + m[o + 4])
+                  y = y + w * (m[o + 5] * px + m[o + 6] * py + m[o + 7] * pz + m[o + 8])
+                  z = z + w * (m[o + 9] * px + m[o + 10] * py + m[o + 11] * pz + m[o + 12])
+                end
+              end
+              if skinOnTick then
+                prevX[v], prevY[v], prevZ[v] = curX[v], curY[v], curZ[v]
+                curX[v], curY[v], curZ[v] = x, y, z
+                tickedCount = tickedCount + 1
+                ticked[tickedCount] = v
+              else
+                for r = vertexRefStarts[v], vertexRefStarts[v + 1] - 1 do
+                  vertexRefs[r]:setPos(x, y, z)
+                end
+              end
+            end
+          end
+          if cursor > last then
+            cursor = boneVertexStarts[b]
+            if restartBones[b] then
+              restartBones[b] = false
+            else
+              isPending[b], boneMotion[b] = false, 0
+            end
+          end
+          boneCursors[b] = cursor
+        end
+        if isPending[b] then
+          kept = kept + 1
+          pendingBones[kept] = b
+        end
+      end
+      pendingCount = kept
+    end
+
     function events.entity_init()
-      function events.render()
-        local boneMats = {}
-        for _, bone in ipairs(boneTree) do
-          boneMats[bone.index] = (boneMats[bone.parent] or mat4) * bone.modelPart:getPositionMatrix()
+      if skinOnTick then
+        for v = 1, #restX do
+          prevX[v], prevY[v], prevZ[v] = restX[v], restY[v], restZ[v]
+          curX[v], curY[v], curZ[v] = restX[v], restY[v], restZ[v]
         end
-        for _, vertData in ipairs(vertices) do
-          if vertData.groupWeights then
-            local weightSum = vec3()
-            for groupIndex, weight in pairs(vertData.groupWeights) do
-              weightSum = weightSum + (boneMats[groupIndex]:apply(vertData.pos) * weight)
+        function events.tick()
+          local previous, previousCount = ticked, tickedCount
+          ticked, tickedCount, settling = settling, 0, previous
+          frame = frame + 1
+          if shouldUpdate() then
+            updateBones()
+            skinVertices()
+          end
+          -- vertices that stopped moving are put exactly where they ended up
+          for i = 1, previousCount do
+            local v = previous[i]
+            if skinnedFrame[v] ~= frame then
+              local x, y, z = curX[v], curY[v], curZ[v]
+              prevX[v], prevY[v], prevZ[v] = x, y, z
+              for r = vertexRefStarts[v], vertexRefStarts[v + 1] - 1 do
+                vertexRefs[r]:setPos(x, y, z)
+              end
             end
-            for _, vert in ipairs(vertData.verts) do
-              vert:setPos(weightSum)
+          end
+        end
+        function events.render(delta, context)
+          if context == "RENDER" and not isVisible() then
+            return
+          end
+          for i = 1, tickedCount do
+            local v = ticked[i]
+            local px, py, pz = prevX[v], prevY[v], prevZ[v]
+            local x, y, z = px + (curX[v] - px) * delta, py + (curY[v] - py) * delta, pz + (curZ[v] - pz) * delta
+            for r = vertexRefStarts[v], vertexRefStarts[v + 1] - 1 do
+              vertexRefs[r]:setPos(x, y, z)
             end
           end
         end
+      else
+        function events.render(_, context)
+          if context == "RENDER" and not shouldUpdate() then
+            return
+          end
+          frame = frame + 1
+          updateBones()
+          skinVertices()
+        end
       end
     end
   end
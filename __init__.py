@@ -1,4 +1,5 @@
 import bpy, math
+import numpy as np
 from bpy.types import (
     Object as BlObject,
     Mesh as BlMesh,
@@ -31,42 +32,207 @@ def fixVector(vector: BlVector) -> BlVector:
     return v
 
 
-def fixUV(uv: tuple[float, float]) -> tuple[float, float]:
-    return (uv[0], 1 - uv[1])
+def fixVectors(vectors: np.ndarray) -> np.ndarray:
+    return vectors[:, (0, 2, 1)] * np.array((-16, 16, 16), dtype=vectors.dtype)
 
 
-def fixAngle(angle, *, rad=False):
-    x, y, z = angle[0], -angle[1], -angle[2]
-    if rad:
-        x, y, z = math.degrees(x), math.degrees(y), math.degrees(z)
-    return (x, y, z)
+def fixUVs(uvs: np.ndarray) -> np.ndarray:
+    uvs = uvs.astype(np.float64)
+    uvs[:, 1] = 1 - uvs[:, 1]
+    return uvs
 
 
-class Vertex:
-    pos: BlVector
-    weights: dict[int, float]
+# Concatenation of range(start, start + count) for every start/count pair
+def concatRanges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(counts.sum())
 
-    def __init__(self, pos: BlVector, weights: dict[int, float]) -> None:
-        self.pos = pos
-        self.weights = weights
 
+# Shelf packing of (width, height) rectangles, tallest first. Rows are as wide as the widest
+# rectangle or the side of a square with the same total area. Returns the (x, y) of every
+# rectangle and the width and height of the packed area
+def packRectangles(
+    sizes: list[tuple[int, int]]
+) -> tuple[list[tuple[int, int]], int, int]:
+    width = max(
+        max(w for w, _ in sizes), math.ceil(math.sqrt(sum(w * h for w, h in sizes)))
+    )
+    positions = [(0, 0)] * len(sizes)
+    x = y = rowHeight = 0
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+        w, h = sizes[i]
+        if x + w > width:
+            x, y, rowHeight = 0, y + rowHeight, 0
+        positions[i] = (x, y)
+        x += w
+        rowHeight = max(rowHeight, h)
+    return positions, width, y + rowHeight
+
+
+# PNG file from already filtered and compressed image data, with extra chunks before it
+def writePNG(
+    width: int,
+    height: int,
+    bitDepth: int,
+    colorType: int,
+    imageData: bytes,
+    chunks: "Iterable[tuple[bytes, bytes]]" = (),
+) -> bytes:
+    import struct, zlib
+
+    def chunk(chunkType: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + chunkType
+            + data
+            + struct.pack(">I", zlib.crc32(chunkType + data))
+        )
 
-class Loop:
-    vertexIndex: int
-    uv: tuple[float, float]
+    header = struct.pack(">IIBBBBB", width, height, bitDepth, colorType, 0, 0, 0)
+    return b"".join(
+        (
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", header),
+            *(chunk(chunkType, data) for chunkType, data in chunks),
+            chunk(b"IDAT", imageData),
+            chunk(b"IEND", b""),
+        )
+    )
 
-    def __init__(self, vertexIndex: int, uv: tuple[float, float]) -> None:
-        self.vertexIndex = vertexIndex
-        self.uv = uv
 
+# PNG file of a (height, width, channels) uint8 image, top row first.
+# 1 channel is grayscale, 2 grayscale with alpha, 3 RGB and 4 RGBA
+def encodePNG(pixels: np.ndarray) -> bytes:
+    import zlib
+
+    height, width, channels = pixels.shape
+    colorType = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+    # every row starts with filter type 0, no filter
+    rows = np.zeros((height, width * channels + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * channels)
+    return writePNG(width, height, 8, colorType, zlib.compress(rows.tobytes()))
+
+
+# Rows of a PNG image with the best filter for every row, picked by the smallest sum of
+# absolute differences like libpng does. bytesPerPixel is at least 1.
+# Filters blockSize bytes of rows at a time, so big images never have all five filters in memory
+def filterRows(rows: np.ndarray, bytesPerPixel: int, blockSize: int = 1 << 18) -> np.ndarray:
+    height, rowSize = rows.shape
+    out = np.empty((height, rowSize + 1), dtype=np.uint8)
+    blockRows = max(1, blockSize // rowSize)
+    previous = np.zeros(rowSize, dtype=np.int16)
+    for start in range(0, height, blockRows):
+        raw = rows[start : start + blockRows].astype(np.int16)
+        left = np.zeros_like(raw)
+        left[:, bytesPerPixel:] = raw[:, :-bytesPerPixel]
+        up = np.empty_like(raw)
+        up[0] = previous
+        up[1:] = raw[:-1]
+        upLeft = np.zeros_like(raw)
+        upLeft[:, bytesPerPixel:] = up[:, :-bytesPerPixel]
+        estimate = left + up - upLeft
+        distLeft, distUp, distUpLeft = (
+            np.abs(estimate - left),
+            np.abs(estimate - up),
+            np.abs(estimate - upLeft),
+        )
+        paeth = np.where(
+            (distLeft <= distUp) & (distLeft <= distUpLeft),
+            left,
+            np.where(distUp <= distUpLeft, up, upLeft),
+        )
+        block = out[start : start + len(raw)]
+        bestCost = None
+        # none, sub, up, average and paeth, ties go to the first one
+        for filterType, prediction in enumerate((0, left, up, (left + up) // 2, paeth)):
+            filtered = (raw - prediction).astype(np.uint8)
+            cost = np.abs(filtered.view(np.int8).astype(np.int16)).sum(axis=1, dtype=np.int64)
+            better = slice(None) if bestCost is None else cost < bestCost
+            bestCost = cost if bestCost is None else np.minimum(cost, bestCost)
+            block[better, 0] = filterType
+            block[better, 1:] = filtered[better]
+        previous = raw[-1]
+    return out
+
+
+# Smallest lossless PNG of a (height, width, 4) uint8 RGBA image, top row first.
+# Drops alpha when everything is opaque, uses grayscale or a palette when the colours allow it,
+# with the lowest bit depth that fits, and compresses at the highest level
+def optimizePNG(pixels: np.ndarray) -> bytes:
+    import zlib
+
+    height, width = pixels.shape[:2]
+    opaque = bool((pixels[:, :, 3] == 255).all())
+    gray = bool(
+        (pixels[:, :, 0] == pixels[:, :, 1]).all()
+        and (pixels[:, :, 1] == pixels[:, :, 2]).all()
+    )
+
+    # (color type, bit depth, (height, width, samples) samples, chunks)
+    candidates = []
+    if gray and opaque:
+        samples, bitDepth = pixels[:, :, :1], 8
+        for depth in (1, 2, 4):
+            step = 255 // (2**depth - 1)
+            if (samples % step == 0).all():
+                samples, bitDepth = samples // step, depth
+                break
+        candidates.append((0, bitDepth, samples, []))
+    elif gray:
+        candidates.append((4, 8, pixels[:, :, (0, 3)], []))
+    elif opaque:
+        candidates.append((2, 8, pixels[:, :, :3], []))
+    else:
+        candidates.append((6, 8, pixels, []))
+
+    packed = np.ascontiguousarray(pixels).view(np.uint32).reshape(-1)
+    colors = np.unique(packed)
+    if len(colors) <= 256:
+        indices = np.searchsorted(colors, packed)
+        colors = colors.view(np.uint8).reshape(-1, 4)
+        # translucent colours first, so the alpha chunk can stop at the last one of them
+        order = np.argsort(colors[:, 3] == 255, kind="stable")
+        colors = colors[order]
+        remap = np.empty(len(order), dtype=np.uint8)
+        remap[order] = np.arange(len(order))
+        translucent = int((colors[:, 3] != 255).sum())
+        chunks = [(b"PLTE", colors[:, :3].tobytes())]
+        if translucent:
+            chunks.append((b"tRNS", colors[:translucent, 3].tobytes()))
+        bitDepth = next(depth for depth in (1, 2, 4, 8) if len(colors) <= 2**depth)
+        samples = remap[indices.reshape(height, width, 1)]
+        candidates.append((3, bitDepth, samples, chunks))
+
+    best = None
+    for colorType, bitDepth, samples, chunks in candidates:
+        channels = samples.shape[2]
+        if bitDepth < 8:
+            bits = samples.reshape(height, width, 1) >> np.arange(bitDepth - 1, -1, -1, dtype=np.uint8)
+            rows = np.packbits(bits.reshape(height, width * bitDepth) & 1, axis=1)
+        else:
+            rows = np.ascontiguousarray(samples).reshape(height, width * channels)
+        # images with less than 8 bits per pixel usually do best without filters.
+        # Only one filtered copy of the image exists at a time
+        for filtered in (False, True) if bitDepth == 8 else (False,):
+            if filtered:
+                option = filterRows(rows, channels)
+            else:
+                option = np.zeros((height, rows.shape[1] + 1), dtype=np.uint8)
+                option[:, 1:] = rows
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9)
+            imageData = compressor.compress(option) + compressor.flush()
+            del option
+            data = writePNG(width, height, bitDepth, colorType, imageData, chunks)
+            if best is None or len(data) < len(best):
+                best = data
+    return best
 
-class Face:
-    texture: int
-    loopIndices: list[int]
 
-    def __init__(self, texture: int, loopIndices: list[int]) -> None:
-        self.texture = texture
-        self.loopIndices = loopIndices
+def fixAngle(angle, *, rad=False):
+    x, y, z = angle[0], -angle[1], -angle[2]
+    if rad:
+        x, y, z = math.degrees(x), math.degrees(y), math.degrees(z)
+    return (x, y, z)
 
 
 class Bone:
@@ -107,33 +273,245 @@ class Bone:
         )
 
 
+class DataURI:
+    mimeType: str
+    data: bytes | None
+    filepath: str | None
+    # base64 of the content, kept between writes. Always kept for data, as it is already in memory
+    encoded: str | None
+
+    def __init__(
+        self,
+        mimeType: str,
+        *,
+        data: bytes | None = None,
+        filepath: str | None = None,
+        encoded: str | None = None,
+    ) -> None:
+        self.mimeType = mimeType
+        self.data = data
+        self.filepath = filepath
+        self.encoded = encoded
+
+    # Yields the uri piece by piece. Files without encoded are read and base64 encoded
+    # at most chunkSize bytes at a time on every write
+    def chunks(self, chunkSize: int = 3 * 1024 * 16) -> "Iterator[str]":
+        from base64 import b64encode
+
+        yield f"data:{self.mimeType};base64,"
+        if self.encoded is None and self.data is not None:
+            self.encoded = b64encode(self.data).decode()
+        if self.encoded is not None:
+            encodedSize = chunkSize // 3 * 4
+            for i in range(0, len(self.encoded), encodedSize):
+                yield self.encoded[i : i + encodedSize]
+            return
+        with open(self.filepath, "rb") as file:
+            while chunk := file.read(chunkSize):
+                yield b64encode(chunk).decode()
+
+    def size(self) -> int:
+        import os
+
+        return len(self.data) if self.data is not None else os.path.getsize(self.filepath)
+
+
 class Texture:
     name: str
-    base64 = str
+    source: DataURI
+    # (height, width, 4) uint8 RGBA pixels, top row first. Only read when the pixels are needed
+    loadPixels: "Callable[[], np.ndarray] | None"
+    # Base Color of materials without an image
+    solidColor: tuple[float, ...] | None
+    # False when source has more precision than loadPixels, like 16 bit and float image files
+    exactPixels: bool
+
+    # Images read or generated during this Blender session, so re-exporting does not read and
+    # encode unchanged textures again. Keyed by content hash, or by the parameters of a generated texture
+    cache: dict[object, DataURI] = {}
+    # (filepath, size, modification time) -> content hash of image files
+    fileHashes: dict[tuple[str, int, int], str] = {}
+    # Image files up to this size keep their base64 in the cache. Bigger files are only cached by
+    # path and streamed from disk on every write, so they never have to fit in memory
+    encodedFileLimit = 4 * 1024 * 1024
 
-    def __init__(self, name: str, base64: str) -> None:
+    def __init__(
+        self,
+        name: str,
+        source: DataURI,
+        loadPixels: "Callable[[], np.ndarray] | None" = None,
+    ) -> None:
         self.name = name
-        self.base64 = base64
+        self.source = source
+        self.loadPixels = loadPixels
+        self.solidColor = None
+        self.exactPixels = True
 
+    # The cached source with the same content as data, adding it if there is none
     @staticmethod
-    def parseImage(image: BlImage):
+    def cachedSource(data: bytes) -> tuple[str, DataURI]:
+        from hashlib import sha256
+
+        contentHash = sha256(data).hexdigest()
+        if contentHash not in Texture.cache:
+            Texture.cache[contentHash] = DataURI("image/png", data=data)
+        return contentHash, Texture.cache[contentHash]
+
+    # Forgets everything the given textures do not use, so old versions of edited images are let go
+    @staticmethod
+    def pruneCache(textures: list["Texture"]):
+        used = {id(texture.source) for texture in textures}
+        Texture.cache = {
+            key: source for key, source in Texture.cache.items() if id(source) in used
+        }
+        Texture.fileHashes = {
+            fileKey: contentHash
+            for fileKey, contentHash in Texture.fileHashes.items()
+            if contentHash in Texture.cache
+        }
+
+    @staticmethod
+    def fileKey(filepath: str) -> tuple[str, int, int] | None:
         import os
 
-        filepath = bpy.path.abspath(image.filepath)
-        markDel = False
         if not os.path.exists(filepath):
-            filepath = bpy.path.abspath(f"//{image.name}")
-            image.save(filepath=filepath)
-            markDel = True
-        data = None
+            return None
+        stat = os.stat(filepath)
+        return (filepath, stat.st_size, stat.st_mtime_ns)
+
+    # sha256 of a file and, for files up to encodedFileLimit, its base64. Big files are hashed a chunk at a time
+    @staticmethod
+    def readFile(filepath: str, chunkSize: int = 1024 * 1024) -> tuple[str, str | None]:
+        import os
+        from base64 import b64encode
+        from hashlib import sha256
+
         with open(filepath, "rb") as file:
-            from base64 import b64encode
+            if os.path.getsize(filepath) <= Texture.encodedFileLimit:
+                data = file.read()
+                return sha256(data).hexdigest(), b64encode(data).decode()
+            contentHash = sha256()
+            while chunk := file.read(chunkSize):
+                contentHash.update(chunk)
+        return contentHash.hexdigest(), None
+
+    # Whether source still has the content with this hash. Sources of big files are
+    # read again on every write, and may point to a file that was edited or removed since
+    @staticmethod
+    def isCurrent(source: DataURI | None, contentHash: str) -> bool:
+        return source is not None and (
+            source.encoded is not None
+            or source.filepath is None
+            or Texture.fileHashes.get(Texture.fileKey(source.filepath)) == contentHash
+        )
+
+    @staticmethod
+    def parseImage(image: BlImage):
+        import os
 
-            data = b64encode(file.read()).decode()
-        if markDel:
-            os.remove(filepath)
         textureName, _ = os.path.splitext(bpy.path.ensure_ext(image.name, ".png"))
-        return Texture(textureName, f"data:image/png;base64,{data}")
+        loadPixels = lambda: Texture.readPixels(image)
+        filepath = bpy.path.abspath(image.filepath)
+        fileKey = Texture.fileKey(filepath)
+        if fileKey is not None:
+            contentHash = Texture.fileHashes.get(fileKey)
+            source = Texture.cache.get(contentHash)
+            if not Texture.isCurrent(source, contentHash):
+                contentHash, encoded = Texture.readFile(filepath)
+                Texture.fileHashes[fileKey] = contentHash
+                source = Texture.cache.get(contentHash)
+                if not Texture.isCurrent(source, contentHash):
+                    source = DataURI("image/png", filepath=filepath, encoded=encoded)
+                    Texture.cache[contentHash] = source
+            texture = Texture(textureName, source, loadPixels)
+            # readPixels rounds float buffers to 8 bits and converts them to sRGB
+            texture.exactPixels = not image.is_float
+            return texture
+        # packed or generated in Blender, encoded straight from its pixels
+        data = encodePNG(Texture.readPixels(image))
+        return Texture(textureName, Texture.cachedSource(data)[1], loadPixels)
+
+    # (height, width, 4) uint8 RGBA pixels of the image, top row first
+    @staticmethod
+    def readPixels(image: BlImage) -> np.ndarray:
+        width, height = image.size
+        pixels = np.empty(width * height * image.channels, dtype=np.float32)
+        image.pixels.foreach_get(pixels)
+        pixels = pixels.reshape(height, width, image.channels)[::-1]
+        if image.channels < 3:
+            pixels = np.concatenate(
+                (pixels[:, :, :1].repeat(3, axis=2), pixels[:, :, 1:]), axis=2
+            )
+        if pixels.shape[2] == 3:
+            pixels = np.concatenate(
+                (pixels, np.ones((height, width, 1), dtype=np.float32)), axis=2
+            )
+        if image.is_float:
+            # float buffers are linear, PNGs are sRGB
+            rgb = np.clip(pixels[:, :, :3], 0, 1)
+            pixels[:, :, :3] = np.where(
+                rgb <= 0.0031308, rgb * 12.92, 1.055 * rgb ** (1 / 2.4) - 0.055
+            )
+        return np.rint(np.clip(pixels, 0, 1) * 255).astype(np.uint8)
+
+    # Copies of the textures with losslessly recompressed sources, see optimizePNG.
+    # Textures without exactPixels keep their source.
+    # Compressed on a thread pool and cached by the content hash of the original
+    @staticmethod
+    def optimizeTextures(textures: list["Texture"]) -> list["Texture"]:
+        from concurrent.futures import ThreadPoolExecutor
+        from copy import copy
+
+        contentHashes = {
+            id(source): key for key, source in Texture.cache.items() if isinstance(key, str)
+        }
+        keys = [
+            ("optimized", contentHashes[id(texture.source)])
+            if id(texture.source) in contentHashes
+            and texture.loadPixels is not None
+            and texture.exactPixels
+            else None
+            for texture in textures
+        ]
+        # pixels are read up front, Blender must only be used from the main thread
+        pending = {}
+        for key, texture in zip(keys, textures):
+            if key is not None and key not in Texture.cache and key not in pending:
+                pending[key] = (texture.source, texture.loadPixels())
+        with ThreadPoolExecutor() as pool:
+            results = pool.map(optimizePNG, [pixels for _, pixels in pending.values()])
+            for (key, (source, _)), data in zip(pending.items(), results):
+                # some files are already smaller than what optimizePNG manages
+                if len(data) < source.size():
+                    source = DataURI("image/png", data=data)
+                Texture.cache[key] = source
+        optimized = []
+        for key, texture in zip(keys, textures):
+            texture = copy(texture)
+            if key is not None:
+                texture.source = Texture.cache[key]
+            optimized.append(texture)
+        return optimized
+
+    # Generated textures are cached by the parameters they are made from, so they are only made once
+    @staticmethod
+    def parseGenerated(name: str, key: tuple, generate: "Callable[[], np.ndarray]"):
+        if key not in Texture.cache:
+            Texture.cache[key] = Texture.cachedSource(encodePNG(generate()))[1]
+        return Texture(name, Texture.cache[key], generate)
+
+    # Magenta on every other column and black in between
+    @staticmethod
+    def generateMissing(size: int = 16) -> np.ndarray:
+        pixels = np.zeros((size, size, 4), dtype=np.uint8)
+        pixels[:, :, 3] = 255
+        pixels[:, ::2] = (255, 0, 255, 255)
+        return pixels
+
+    @staticmethod
+    def generateSolid(color: tuple[float, ...], size: int = 1) -> np.ndarray:
+        pixel = np.rint(np.clip(np.array(color, dtype=np.float64), 0, 1) * 255)
+        return np.tile(pixel.astype(np.uint8), (size, size, 1))
 
     @staticmethod
     def parseMaterial(material: BlMaterial):
@@ -145,71 +523,261 @@ class Texture:
                 break
         if shaderNode is None or shaderNode.bl_idname != "ShaderNodeBsdfPrincipled":
             if shaderNode and shaderNode.bl_idname == "ShaderNodeTexImage":
-                return Texture.parseImage(textureNode.image)
-            img = bpy.data.images.new(f"null_{material.name}", 16, 16)
-            color = (1, 0, 1, 1)
-            for p in range(0, 16 * 16 * 4, 8):
-                for i in range(4):
-                    img.pixels[p + i] = color[i]
-            img.file_format = "PNG"
-            texture = Texture.parseImage(img)
-            bpy.data.images.remove(img)
-            return texture
+                return Texture.parseImage(shaderNode.image)
+            return Texture.parseGenerated(
+                f"null_{material.name}", ("missing", 16), Texture.generateMissing
+            )
         textureNode = None
         for link in material.node_tree.links:
             if link.to_node == shaderNode and link.to_socket.name == "Base Color":
                 textureNode = link.from_node
                 break
         if textureNode is None or textureNode.bl_idname != "ShaderNodeTexImage":
-            img = bpy.data.images.new(f"solid_{material.name}", 1, 1)
-            color = shaderNode.inputs["Base Color"].default_value
-            for i in range(4):
-                img.pixels[i] = color[i]
-            img.file_format = "PNG"
-            texture = Texture.parseImage(img)
-            bpy.data.images.remove(img)
+            color = tuple(shaderNode.inputs["Base Color"].default_value)
+            texture = Texture.parseGenerated(
+                f"solid_{material.name}",
+                ("solid", 1, color),
+                lambda: Texture.generateSolid(color),
+            )
+            texture.solidColor = color
             return texture
         return Texture.parseImage(textureNode.image)
 
 
 class Mesh:
-    vertices: list[Vertex]
-    loops: list[Loop]
-    faces: list[Face]
+    # Structure of arrays. Vertex weights are stored sparse, like a CSR matrix:
+    # the influences of vertex i are weightGroups/weightValues[weightOffsets[i]:weightOffsets[i + 1]]
+    positions: np.ndarray  # float32 (vertices, 3)
+    weightOffsets: np.ndarray  # int32 (vertices + 1)
+    weightGroups: np.ndarray  # int32 (influences)
+    weightValues: np.ndarray  # float32 (influences)
+    loopVertices: np.ndarray  # int32 (loops)
+    loopUVs: np.ndarray  # float64 (loops, 2)
+    faceLoopStart: np.ndarray  # int32 (faces)
+    faceLoopTotal: np.ndarray  # int32 (faces)
+    faceTextures: np.ndarray  # int32 (faces)
+
+    def __init__(
+        self,
+        positions: np.ndarray,
+        weightOffsets: np.ndarray,
+        weightGroups: np.ndarray,
+        weightValues: np.ndarray,
+        loopVertices: np.ndarray,
+        loopUVs: np.ndarray,
+        faceLoopStart: np.ndarray,
+        faceLoopTotal: np.ndarray,
+        faceTextures: np.ndarray,
+    ):
+        self.positions = positions
+        self.weightOffsets = weightOffsets
+        self.weightGroups = weightGroups
+        self.weightValues = weightValues
+        self.loopVertices = loopVertices
+        self.loopUVs = loopUVs
+        self.faceLoopStart = faceLoopStart
+        self.faceLoopTotal = faceLoopTotal
+        self.faceTextures = faceTextures
+
+    @property
+    def vertexCount(self) -> int:
+        return len(self.positions)
+
+    # (faces, 4) loop indices of every face. Triangles repeat their last loop, matching how Figura stores them.
+    def faceCorners(self) -> np.ndarray:
+        return self.faceLoopStart[:, None] + np.minimum(
+            np.arange(4), self.faceLoopTotal[:, None] - 1
+        )
+
+    # The vertex index of every influence in weightGroups/weightValues
+    def influenceVertices(self) -> np.ndarray:
+        return np.repeat(np.arange(self.vertexCount), np.diff(self.weightOffsets))
+
+    def withWeights(
+        self, weightOffsets: np.ndarray, weightGroups: np.ndarray, weightValues: np.ndarray
+    ) -> "Mesh":
+        return Mesh(
+            self.positions,
+            weightOffsets,
+            weightGroups,
+            weightValues,
+            self.loopVertices,
+            self.loopUVs,
+            self.faceLoopStart,
+            self.faceLoopTotal,
+            self.faceTextures,
+        )
+
+    # Mesh made of only the selected faces, with unused vertices and loops removed
+    def subset(self, faces: np.ndarray) -> "Mesh":
+        faceLoopTotal = self.faceLoopTotal[faces]
+        loops = concatRanges(self.faceLoopStart[faces], faceLoopTotal)
+        vertices, loopVertices = np.unique(self.loopVertices[loops], return_inverse=True)
+        weightCounts = np.diff(self.weightOffsets)[vertices]
+        weightOffsets = np.zeros(len(vertices) + 1, dtype=np.int32)
+        np.cumsum(weightCounts, out=weightOffsets[1:])
+        influences = concatRanges(self.weightOffsets[vertices], weightCounts)
+        return Mesh(
+            self.positions[vertices],
+            weightOffsets,
+            self.weightGroups[influences],
+            self.weightValues[influences],
+            loopVertices.astype(np.int32),
+            self.loopUVs[loops],
+            (np.cumsum(faceLoopTotal) - faceLoopTotal).astype(np.int32),
+            faceLoopTotal,
+            self.faceTextures[faces],
+        )
+
+    # Keeps the largest maxInfluences weights of every vertex and renormalizes them to sum to 1
+    def limitInfluences(self, maxInfluences: int) -> "Mesh":
+        vertexIndices = self.influenceVertices()
+        order = np.lexsort((-self.weightValues, vertexIndices))
+        rank = np.arange(len(order)) - self.weightOffsets[vertexIndices[order]]
+        keep = np.zeros(len(order), dtype=bool)
+        keep[order[rank < maxInfluences]] = True
+        return self.keepInfluences(keep)
+
+    # Keeps only the weights of groups that are bones and renormalizes them to sum to 1
+    def normalizeWeights(self, groupIsBone: np.ndarray) -> "Mesh":
+        return self.keepInfluences(groupIsBone[self.weightGroups])
+
+    # Keeps the selected influences and renormalizes every vertex to sum to 1
+    def keepInfluences(self, keep: np.ndarray) -> "Mesh":
+        vertexIndices = self.influenceVertices()[keep]
+        weightValues = self.weightValues[keep]
+        totals = np.bincount(vertexIndices, weightValues, self.vertexCount)
+        weightOffsets = np.zeros(self.vertexCount + 1, dtype=np.int32)
+        np.cumsum(
+            np.bincount(vertexIndices, minlength=self.vertexCount), out=weightOffsets[1:]
+        )
+        return self.withWeights(
+            weightOffsets,
+            self.weightGroups[keep],
+            (weightValues / totals[vertexIndices]).astype(np.float32),
+        )
 
-    def __init__(self, vertices: list[Vertex], loops: list[Loop], faces: list[Face]):
-        self.vertices = vertices
-        self.loops = loops
-        self.faces = faces
+    # Normalized weights as integers out of steps. The largest weight of every vertex takes the
+    # rounding error, so they still add up to exactly steps
+    def quantizeWeights(self, steps: int) -> np.ndarray:
+        vertexIndices = self.influenceVertices()
+        totals = np.bincount(vertexIndices, self.weightValues, self.vertexCount)
+        quantized = np.rint(self.weightValues / totals[vertexIndices] * steps).astype(np.int64)
+        weighted = np.diff(self.weightOffsets) > 0
+        residuals = steps - np.bincount(vertexIndices, quantized, self.vertexCount)
+        order = np.lexsort((-self.weightValues, vertexIndices))
+        quantized[order[self.weightOffsets[:-1][weighted]]] += residuals[weighted].astype(np.int64)
+        return quantized
+
+    # Groups vertices that share the same normalized weights, quantized to 1/255.
+    # Returns the palettes as CSR (offsets, groups, quantized weights) and the palette of every vertex, -1 for none.
+    def weightPalettes(
+        self,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        vertexIndices = self.influenceVertices()
+        totals = np.bincount(vertexIndices, self.weightValues, self.vertexCount)
+        quantized = np.rint(
+            self.weightValues / totals[vertexIndices] * 255
+        ).astype(np.int32)
+        order = np.lexsort((self.weightGroups, vertexIndices))
+        order = order[quantized[order] > 0]
+        counts = np.bincount(vertexIndices[order], minlength=self.vertexCount)
+        rank = np.arange(len(order)) - (np.cumsum(counts) - counts)[vertexIndices[order]]
+        # one row of (group, weight, group, weight...) per vertex, padded with -1
+        keys = np.full((self.vertexCount, 2 * counts.max(initial=0)), -1, dtype=np.int32)
+        keys[vertexIndices[order], 2 * rank] = self.weightGroups[order]
+        keys[vertexIndices[order], 2 * rank + 1] = quantized[order]
+
+        weighted = counts > 0
+        palettes, inverse = np.unique(keys[weighted], axis=0, return_inverse=True)
+        vertexPalettes = np.full(self.vertexCount, -1, dtype=np.int32)
+        vertexPalettes[weighted] = inverse.ravel()
+        used = palettes[:, 0::2] >= 0
+        paletteOffsets = np.zeros(len(palettes) + 1, dtype=np.int32)
+        np.cumsum(used.sum(axis=1), out=paletteOffsets[1:])
+        return (
+            paletteOffsets,
+            palettes[:, 0::2][used],
+            palettes[:, 1::2][used],
+            vertexPalettes,
+        )
+
+    # Positions deformed the same way the driver does it, with (groups, 4, 4) matrices in figura space
+    def skin(self, groupMatrices: np.ndarray) -> np.ndarray:
+        vertexIndices = self.influenceVertices()
+        points = np.ones((len(vertexIndices), 4))
+        points[:, :3] = self.positions[vertexIndices]
+        transformed = np.einsum(
+            "nij,nj->ni", groupMatrices[self.weightGroups, :3], points
+        ) * self.weightValues[:, None]
+        totals = np.bincount(vertexIndices, self.weightValues, self.vertexCount)
+        skinned = self.positions.astype(np.float64)
+        weighted = totals > 0
+        for axis in range(3):
+            skinned[weighted, axis] = (
+                np.bincount(vertexIndices, transformed[:, axis], self.vertexCount)[
+                    weighted
+                ]
+                / totals[weighted]
+            )
+        return skinned
+
+    @staticmethod
+    def parseWeights(mesh: BlMesh) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        vertexGroups = [vertex.groups for vertex in mesh.vertices]
+        counts = np.fromiter(
+            (len(groups) for groups in vertexGroups), np.int32, len(vertexGroups)
+        )
+        offsets = np.zeros(len(vertexGroups) + 1, dtype=np.int32)
+        np.cumsum(counts, out=offsets[1:])
+        groupIndices = np.empty(offsets[-1], dtype=np.int32)
+        weights = np.empty(offsets[-1], dtype=np.float32)
+        for groups, start, end in zip(
+            vertexGroups, offsets[:-1].tolist(), offsets[1:].tolist()
+        ):
+            if start != end:
+                groups.foreach_get("group", groupIndices[start:end])
+                groups.foreach_get("weight", weights[start:end])
+
+        keep = weights >= 0.0001
+        vertexIndices = np.repeat(np.arange(len(vertexGroups)), counts)
+        np.cumsum(
+            np.bincount(vertexIndices[keep], minlength=len(vertexGroups)),
+            out=offsets[1:],
+        )
+        return offsets, groupIndices[keep], weights[keep]
 
     @staticmethod
     def parseMesh(mesh: BlMesh) -> "Mesh":
-        uvs = mesh.uv_layers[0].data
-        loops = []
-        for loop in mesh.loops:
-            for f in mesh.polygons:
-                if loop.index in f.loop_indices and f.loop_total in {3, 4}:
-                    loops.append(Loop(loop.vertex_index, fixUV(uvs[loop.index].uv)))
-                    break
+        positions = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", positions)
+
+        loopVertices = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", loopVertices)
+        loopUVs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+        mesh.uv_layers[0].data.foreach_get("uv", loopUVs)
+
+        faceLoopStart = np.empty(len(mesh.polygons), dtype=np.int32)
+        faceLoopTotal = np.empty(len(mesh.polygons), dtype=np.int32)
+        faceTextures = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", faceLoopStart)
+        mesh.polygons.foreach_get("loop_total", faceLoopTotal)
+        mesh.polygons.foreach_get("material_index", faceTextures)
+        # Figura only supports triangles and quads. Loops of other faces are kept so loop indices stay valid.
+        supported = (faceLoopTotal == 3) | (faceLoopTotal == 4)
+
+        weightOffsets, weightGroups, weightValues = Mesh.parseWeights(mesh)
 
         return Mesh(
-            [
-                Vertex(
-                    fixVector(vertex.co),
-                    {
-                        group.group: group.weight
-                        for group in vertex.groups
-                        if group.weight >= 0.0001
-                    },
-                )
-                for vertex in mesh.vertices
-            ],
-            loops,
-            [
-                Face(face.material_index, [i for i in face.loop_indices])
-                for face in mesh.polygons
-                if face.loop_total in {3, 4}
-            ],
+            fixVectors(positions.reshape(-1, 3)),
+            weightOffsets,
+            weightGroups,
+            weightValues,
+            loopVertices,
+            fixUVs(loopUVs.reshape(-1, 2)),
+            faceLoopStart[supported],
+            faceLoopTotal[supported],
+            faceTextures[supported],
         )
 
 
@@ -325,6 +893,8 @@ class Object:
     textures: list[Texture]
     vertexGroups: dict[str, int]
     bones: list[Bone]
+    # bone name -> faces moved entirely by that bone. See splitRigidParts
+    rigidParts: dict[str, Mesh]
     #animations: list[Animation]
 
     def __init__(
@@ -343,8 +913,153 @@ class Object:
         self.textures = textures
         self.vertexGroups = vertexGroups
         self.bones = bones
+        self.rigidParts = {}
         #self.animations = animations
 
+    # Moves faces whose vertices are all weighted to the same single bone out of the skinned mesh.
+    # Figura moves those with the bone's group, so the driver never has to touch them.
+    def splitRigidParts(self):
+        groupNames = {index: name for name, index in self.vertexGroups.items()}
+        groupIsBone = self.groupIsBone()
+
+        mesh = self.mesh
+        single = np.diff(mesh.weightOffsets) == 1
+        # the only group of rigidly bound vertices, -1 otherwise
+        vertexGroups = np.full(mesh.vertexCount, -1, dtype=np.int32)
+        vertexGroups[single] = mesh.weightGroups[mesh.weightOffsets[:-1][single]]
+        vertexGroups[~groupIsBone[vertexGroups]] = -1
+        cornerGroups = vertexGroups[mesh.loopVertices[mesh.faceCorners()]]
+        faceGroups = np.where(
+            (cornerGroups == cornerGroups[:, :1]).all(axis=1), cornerGroups[:, 0], -1
+        )
+
+        self.rigidParts = {
+            groupNames[group]: mesh.subset(faceGroups == group)
+            for group in np.unique(faceGroups[faceGroups >= 0]).tolist()
+        }
+        self.mesh = mesh.subset(faceGroups < 0)
+
+    # Replaces the solid colour textures with a single palette texture, one texel per colour.
+    # Every loop of a solid coloured face is pointed at the centre of its colour's texel
+    def mergeSolidColors(self):
+        mesh = self.mesh
+        solid = [
+            textureIndex
+            for textureIndex, texture in enumerate(self.textures)
+            if texture.solidColor is not None
+        ]
+        if not solid:
+            return
+        width = math.ceil(math.sqrt(len(solid)))
+        height = math.ceil(len(solid) / width)
+        palette = np.zeros((height, width, 4), dtype=np.uint8)
+        for i, textureIndex in enumerate(solid):
+            palette[i // width, i % width] = Texture.generateSolid(
+                self.textures[textureIndex].solidColor
+            )[0, 0]
+
+        # old texture index -> new texture index, and the texel centre of solid colours
+        kept = [i for i in range(len(self.textures)) if i not in solid]
+        textureMap = np.zeros(len(self.textures), dtype=np.int32)
+        textureMap[kept] = np.arange(len(kept))
+        textureMap[solid] = len(kept)
+        texelUVs = np.full((len(self.textures), 2), np.nan)
+        texelUVs[solid] = [
+            ((i % width + 0.5) / width, (i // width + 0.5) / height)
+            for i in range(len(solid))
+        ]
+
+        loops = concatRanges(mesh.faceLoopStart, mesh.faceLoopTotal)
+        loopUVs = texelUVs[np.repeat(mesh.faceTextures, mesh.faceLoopTotal)]
+        isSolid = ~np.isnan(loopUVs[:, 0])
+        mesh.loopUVs = mesh.loopUVs.copy()
+        mesh.loopUVs[loops[isSolid]] = loopUVs[isSolid]
+        mesh.faceTextures = textureMap[mesh.faceTextures]
+        self.textures = [self.textures[i] for i in kept] + [
+            Texture(
+                f"{self.name}_palette",
+                Texture.cachedSource(encodePNG(palette))[1],
+                lambda: palette,
+            )
+        ]
+
+    # Crops every texture to the area its UVs use, plus padding pixels around it, and rescales the UVs.
+    # Textures with UVs outside of them, like tiled textures, are left alone
+    def cropTextures(self, padding: int):
+        mesh = self.mesh
+        loops = concatRanges(mesh.faceLoopStart, mesh.faceLoopTotal)
+        loopTextures = np.repeat(mesh.faceTextures, mesh.faceLoopTotal)
+        loopUVs = mesh.loopUVs.copy()
+        for textureIndex, texture in enumerate(self.textures):
+            textureLoops = loops[loopTextures == textureIndex]
+            uvs = loopUVs[textureLoops]
+            if len(uvs) == 0 or uvs.min() < 0 or uvs.max() > 1:
+                continue
+            pixels = texture.loadPixels()
+            height, width = pixels.shape[:2]
+            size = np.array((width, height))
+            low = np.maximum(np.floor(uvs.min(axis=0) * size).astype(int) - padding, 0)
+            high = np.minimum(np.ceil(uvs.max(axis=0) * size).astype(int) + padding, size)
+            # UVs on a pixel edge use no area, keep at least the pixel next to it
+            high = np.minimum(np.maximum(high, low + 1), size)
+            low = np.minimum(low, high - 1)
+            if (low == 0).all() and (high == size).all():
+                continue
+            cropped = pixels[low[1] : high[1], low[0] : high[0]]
+            loopUVs[textureLoops] = (uvs * size - low) / (high - low)
+            self.textures[textureIndex] = Texture(
+                texture.name,
+                Texture.cachedSource(encodePNG(cropped))[1],
+                lambda cropped=cropped: cropped,
+            )
+        mesh.loopUVs = loopUVs
+
+    # Draws every texture the mesh uses into a single atlas texture and moves the UVs into it.
+    # UVs outside of their texture are clamped to its edge, as they would bleed into other textures
+    def packAtlas(self):
+        mesh = self.mesh
+        used = np.unique(mesh.faceTextures).tolist()
+        if not used:
+            return
+        images = [self.textures[textureIndex].loadPixels() for textureIndex in used]
+        sizes = [(image.shape[1], image.shape[0]) for image in images]
+        positions, width, height = packRectangles(sizes)
+        atlas = np.zeros((height, width, 4), dtype=np.uint8)
+        # offset and scale of the UVs of every texture, indexed by old texture index
+        offsets = np.zeros((len(self.textures), 2))
+        scales = np.zeros((len(self.textures), 2))
+        for textureIndex, image, (x, y), (w, h) in zip(used, images, positions, sizes):
+            atlas[y : y + h, x : x + w] = image
+            offsets[textureIndex] = (x / width, y / height)
+            scales[textureIndex] = (w / width, h / height)
+
+        loops = concatRanges(mesh.faceLoopStart, mesh.faceLoopTotal)
+        loopTextures = np.repeat(mesh.faceTextures, mesh.faceLoopTotal)
+        loopUVs = mesh.loopUVs.copy()
+        loopUVs[loops] = offsets[loopTextures] + np.clip(loopUVs[loops], 0, 1) * scales[loopTextures]
+        mesh.loopUVs = loopUVs
+        mesh.faceTextures = np.zeros_like(mesh.faceTextures)
+        self.textures = [
+            Texture(
+                f"{self.name}_atlas",
+                Texture.cachedSource(encodePNG(atlas))[1],
+                lambda: atlas,
+            )
+        ]
+
+    # Which vertex groups belong to a bone, with an extra False at the end for index -1
+    def groupIsBone(self) -> np.ndarray:
+        boneNames = set()
+        bones = list(self.bones)
+        while bones:
+            bone = bones.pop()
+            boneNames.add(bone.name)
+            bones.extend(bone.children)
+        groupNames = {index: name for name, index in self.vertexGroups.items()}
+        return np.array(
+            [groupNames.get(i) in boneNames for i in range(len(groupNames))] + [False]
+        )
+
     @staticmethod
     def parseObject(obj: BlObject) -> "Object":
         from uuid import uuid4
@@ -354,19 +1069,57 @@ class Object:
             if fixGroupName(group.name) in vertexGroups: raise ValueError("Multiple vertex groups with the same name have been detected. Remove the duplicates and try again.")
             vertexGroups[fixGroupName(group.name)]=group.index
 
+        # materials with the same image share one texture
+        mesh = Mesh.parseMesh(obj.data)
+        textures = []
+        textureIndices = {}
+        slotTextures = []
+        for materialSlot in obj.material_slots:
+            texture = Texture.parseMaterial(materialSlot.material)
+            if id(texture.source) not in textureIndices:
+                textureIndices[id(texture.source)] = len(textures)
+                textures.append(texture)
+            slotTextures.append(textureIndices[id(texture.source)])
+        mesh.faceTextures = np.array(slotTextures, dtype=np.int32)[
+            np.minimum(mesh.faceTextures, len(slotTextures) - 1)
+        ]
+
         return Object(
             fixGroupName(obj.name),
             str(uuid4()),
-            Mesh.parseMesh(obj.data),
-            [
-                Texture.parseMaterial(materialSlot.material)
-                for materialSlot in obj.material_slots
-            ],
+            mesh,
+            textures,
             vertexGroups,
             Bone.parseArmature(obj.find_armature().data),
             # Animation.parseObject(obj.find_armature()),
         )
 
+    # Current pose deformation of every vertex group as (groups, 4, 4) matrices in figura space.
+    # Groups without a matching bone do not deform.
+    @staticmethod
+    def parsePoseMatrices(obj: BlObject) -> np.ndarray:
+        axes = np.array(
+            ((-16, 0, 0, 0), (0, 0, 16, 0), (0, 16, 0, 0), (0, 0, 0, 1)), dtype=np.float64
+        )
+        poseBones = obj.find_armature().pose.bones
+        matrices = np.tile(np.eye(4), (len(obj.vertex_groups), 1, 1))
+        for group in obj.vertex_groups:
+            poseBone = poseBones.get(group.name)
+            if poseBone is not None:
+                matrices[group.index] = np.array(
+                    poseBone.matrix @ poseBone.bone.matrix_local.inverted()
+                )
+        return axes @ matrices @ np.linalg.inv(axes)
+
+
+# A dict whose items are produced on demand, so large objects never have to exist in memory at once.
+class LazyDict:
+    def __init__(self, items: "Iterable[tuple[Any, Any]]"):
+        self._items = items
+
+    def items(self):
+        return self._items
+
 
 class JsonParser:
     @staticmethod
@@ -392,6 +1145,56 @@ class JsonParser:
             case _:
                 raise TypeError(f'Unknown type:"{type(obj)}" ({obj})')
 
+    @staticmethod
+    def writeJson(obj: "Any", file, bufferSize: int = 4096):
+        from types import GeneratorType
+
+        buffer: list[str] = []
+        # open containers as [iterator, isObject, isFirst]
+        stack: list[list] = []
+        value = obj
+        while True:
+            match value:
+                case dict() | LazyDict():
+                    buffer.append("{")
+                    stack.append([iter(value.items()), True, True])
+                case list() | tuple() | GeneratorType():
+                    buffer.append("[")
+                    stack.append([iter(value), False, True])
+                case DataURI():
+                    file.write("".join(buffer))
+                    buffer.clear()
+                    file.write('"')
+                    for chunk in value.chunks():
+                        file.write(chunk)
+                    file.write('"')
+                case _:
+                    buffer.append(JsonParser.toJson(value))
+
+            while stack:
+                container = stack[-1]
+                item = next(container[0], stack)
+                if item is stack:
+                    stack.pop()
+                    buffer.append("}" if container[1] else "]")
+                    continue
+                if not container[2]:
+                    buffer.append(",")
+                container[2] = False
+                if container[1]:
+                    key, value = item
+                    buffer.append(f"{JsonParser.toJson(key)}:")
+                else:
+                    value = item
+                break
+            else:
+                file.write("".join(buffer))
+                return
+
+            if len(buffer) >= bufferSize:
+                file.write("".join(buffer))
+                buffer.clear()
+
 
 class LuaParser:
     keywords = [
@@ -458,11 +1261,77 @@ class LuaParser:
             case _:
                 raise TypeError(f'Unknown type:"{type(obj)}" ({obj})')
 
-
-def generateAvatar(name: str, obj: Object):
+    @staticmethod
+    def writeLua(obj: "Any", file, bufferSize: int = 4096):
+        from types import GeneratorType
+
+        buffer: list[str] = []
+        # table key -> "key=" or "[key]=", so each distinct key is only validated once
+        keyPrefixes: dict[object, str] = {}
+        # open tables as [iterator, isDict, isFirst]
+        stack: list[list] = []
+        value = obj
+        while True:
+            match value:
+                case dict() | LazyDict():
+                    buffer.append("{")
+                    stack.append([iter(value.items()), True, True])
+                case list() if value and all(
+                    type(v) is int or type(v) is float for v in value
+                ):
+                    buffer.append(f'{{{",".join(map(str, value))}}}')
+                case list() | tuple() | GeneratorType():
+                    buffer.append("{")
+                    stack.append([iter(value), False, True])
+                case _:
+                    buffer.append(LuaParser.toLua(value))
+
+            while stack:
+                table = stack[-1]
+                item = next(table[0], stack)
+                if item is stack:
+                    stack.pop()
+                    buffer.append("}")
+                    continue
+                if table[1]:
+                    key, value = item
+                    if value is None:
+                        continue
+                    prefix = keyPrefixes.get(key)
+                    if prefix is None:
+                        prefix = keyPrefixes[key] = (
+                            f"{key}="
+                            if LuaParser.isValidName(key)
+                            else f"[{LuaParser.toLua(key)}]="
+                        )
+                else:
+                    value = item
+                    prefix = ""
+                if not table[2]:
+                    buffer.append(",")
+                table[2] = False
+                buffer.append(prefix)
+                break
+            else:
+                file.write("".join(buffer))
+                return
+
+            if len(buffer) >= bufferSize:
+                file.write("".join(buffer))
+                buffer.clear()
+
+
+def generateAvatar(
+    name: str,
+    obj: Object,
+    *,
+    meshDataFormat: str = "TABLE",
+    weightPalettes: bool = False,
+):
     def generateBBModel(obj: Object):
         boneUUIDs = {}
         boneCubes = []
+        rigidMeshes = []
 
         def generateGroup(bone: Bone):
             from uuid import uuid4
@@ -512,15 +1381,59 @@ def generateAvatar(name: str, obj: Object):
                 "children": [generateGroup(child) for child in bone.children],
             }
             group["children"].append(cube["uuid"])
+            if bone.name in obj.rigidParts:
+                rigidMeshes.append(
+                    generateMeshElement(
+                        "RigidMesh", str(uuid4()), obj.rigidParts[bone.name]
+                    )
+                )
+                group["children"].append(rigidMeshes[-1]["uuid"])
             return group
 
+        def generateMeshElement(name: str, uuid: str, mesh: Mesh):
+            loopVertices = mesh.loopVertices.tolist()
+            loopUVs = mesh.loopUVs.tolist()
+            return {
+                "name": name,
+                "origin": [0, 0, 0],
+                "rotation": [0, 0, 0],
+                "vertices": LazyDict(
+                    (str(i), pos.tolist()) for i, pos in enumerate(mesh.positions)
+                ),
+                "faces": LazyDict(
+                    (
+                        str(i),
+                        {
+                            "vertices": [
+                                str(loopVertices[loop])
+                                for loop in range(loopStart, loopStart + loopTotal)
+                            ],
+                            "uv": {
+                                str(loopVertices[loop]): loopUVs[loop]
+                                for loop in range(loopStart, loopStart + loopTotal)
+                            },
+                            "texture": texture,
+                        },
+                    )
+                    for i, (loopStart, loopTotal, texture) in enumerate(
+                        zip(
+                            mesh.faceLoopStart.tolist(),
+                            mesh.faceLoopTotal.tolist(),
+                            mesh.faceTextures.tolist(),
+                        )
+                    )
+                ),
+                "type": "mesh",
+                "uuid": uuid,
+            }
+
         bbmodel = {
             "meta": {"format_version": "4.5", "model_format": "free", "box_uv": False},
             "resolution": {"width": 1, "height": 1},
             "outliner": [generateGroup(bone) for bone in obj.bones],
-            "elements": [cube for cube in boneCubes],
+            "elements": [*boneCubes, *rigidMeshes],
             "textures": [
-                {"name": texture.name, "source": texture.base64}
+                {"name": texture.name, "source": texture.source}
                 for texture in obj.textures
             ],
             # "animations":[
@@ -549,66 +1462,109 @@ def generateAvatar(name: str, obj: Object):
             # ]
         }
         bbmodel["outliner"].append(obj.uuid)
-        bbmodel["elements"].append(
-            {
-                "name": "Mesh",
-                "origin": [0, 0, 0],
-                "rotation": [0, 0, 0],
-                "vertices": {
-                    str(i): [vert.pos.x, vert.pos.y, vert.pos.z]
-                    for i, vert in enumerate(obj.mesh.vertices)
-                },
-                "faces": {
-                    str(i): {
-                        "vertices": [
-                            str(obj.mesh.loops[loop].vertexIndex)
-                            for loop in face.loopIndices
-                        ],
-                        "uv": {
-                            str(obj.mesh.loops[loop].vertexIndex): [
-                                obj.mesh.loops[loop].uv[0],
-                                obj.mesh.loops[loop].uv[1],
-                            ]
-                            for loop in face.loopIndices
-                        },
-                        "texture": face.texture,
-                    }
-                    for i, face in enumerate(obj.mesh.faces)
-                },
-                "type": "mesh",
-                "uuid": obj.uuid,
-            }
-        )
-        return JsonParser.toJson(bbmodel)
+        bbmodel["elements"].append(generateMeshElement("Mesh", obj.uuid, obj.mesh))
+        return bbmodel
+
+    def generateMeshData(
+        name: str, obj: Object, meshDataFormat: str, weightPalettes: bool
+    ):
+        # weights are normalized here, so the driver can use them as they are
+        mesh = obj.mesh.normalizeWeights(obj.groupIsBone())
 
-    def generateMeshData(name: str, obj: Object):
         # @type [texture:[list of corners using that texture]]
-        figuraVertexMap = [[] for _ in obj.textures]
-        for face in obj.mesh.faces:
-            for loopIndex in face.loopIndices:
-                figuraVertexMap[face.texture].append(loopIndex)
-                if (
-                    len(face.loopIndices) == 3
-                    and loopIndex == face.loopIndices[len(face.loopIndices) - 1]
-                ):
-                    figuraVertexMap[face.texture].append(loopIndex)
-
-        def generateLoopIndices(vertexIndex: int):
-            textureVertexIndices: dict[int, list[int]] = {}
-            for textureIndex, loops in enumerate(figuraVertexMap):
-                for loopIndex in loops:
-                    if obj.mesh.loops[loopIndex].vertexIndex == vertexIndex:
-                        break
-                else:
+        faceCorners = mesh.faceCorners()
+        figuraVertexMap = [
+            faceCorners[mesh.faceTextures == textureIndex].ravel()
+            for textureIndex in range(len(obj.textures))
+        ]
+
+        # @type [vertex:{texture:[figura vertices of that texture]}]
+        vertexLoopIndices: list[dict[int, list[int]]] = [
+            {} for _ in range(mesh.vertexCount)
+        ]
+        for textureIndex, loops in enumerate(figuraVertexMap):
+            for index, vertexIndex in enumerate(mesh.loopVertices[loops].tolist()):
+                vertexLoopIndices[vertexIndex].setdefault(textureIndex + 1, []).append(
+                    index + 1
+                )
+
+        weightOffsets = mesh.weightOffsets.tolist()
+        weightGroups = mesh.weightGroups.tolist()
+        weightValues = (mesh.quantizeWeights(10000) / 10000).tolist()
+        if weightPalettes:
+            (
+                paletteOffsets,
+                paletteGroups,
+                paletteWeights,
+                vertexPalettes,
+            ) = mesh.weightPalettes()
+            paletteTotals = np.add.reduceat(paletteWeights, paletteOffsets[:-1])
+            paletteWeights = np.round(
+                paletteWeights / np.repeat(paletteTotals, np.diff(paletteOffsets)), 4
+            ).tolist()
+            paletteOffsets = paletteOffsets.tolist()
+            paletteGroups = paletteGroups.tolist()
+            vertexPalettes = vertexPalettes.tolist()
+
+        # Per vertex, as unsigned LEB128 varints:
+        #   textureCount, {textureIndex, count, figura vertex index deltas...}...
+        #   rest position x, y, z in 1/4096ths, zigzag encoded
+        #   weightCount, {groupIndex, weight as little endian uint16 / 65535}...
+        # or with palettes, instead of the weights:
+        #   paletteIndex, 0 for none
+        def packVertexData():
+            from base64 import b64encode
+
+            data = bytearray()
+
+            def varint(value: int):
+                while value >= 0x80:
+                    data.append(value & 0x7F | 0x80)
+                    value >>= 7
+                data.append(value)
+
+            quantizedWeights = mesh.quantizeWeights(0xFFFF).astype("<u2").tobytes()
+            fixedPositions = np.rint(mesh.positions * 4096).astype(np.int64).tolist()
+            for index, loops in enumerate(vertexLoopIndices):
+                varint(len(loops))
+                for textureIndex, indices in loops.items():
+                    varint(textureIndex)
+                    varint(len(indices))
+                    previous = 0
+                    for i in indices:
+                        varint(i - previous)
+                        previous = i
+                for value in fixedPositions[index]:
+                    varint(value * 2 if value >= 0 else -value * 2 - 1)
+                if weightPalettes:
+                    varint(vertexPalettes[index] + 1)
                     continue
-                textureVertexIndices[textureIndex] = []
-                for index, loopIndex in enumerate(loops):
-                    if obj.mesh.loops[loopIndex].vertexIndex == vertexIndex:
-                        textureVertexIndices[textureIndex].append(index)
-            return {
-                textureIndex + 1: [x + 1 for x in loops]
-                for textureIndex, loops in textureVertexIndices.items()
-            }
+                start, end = weightOffsets[index], weightOffsets[index + 1]
+                varint(end - start)
+                for i in range(start, end):
+                    varint(weightGroups[i] + 1)
+                    data += quantizedWeights[i * 2 : i * 2 + 2]
+            return b64encode(data).decode()
+
+        # @type [bone:{name, parent bone, vertex group}], parents before their children.
+        # Bones without a vertex group still move their children, so they are kept with no group.
+        bones = []
+
+        def addBone(bone: Bone, parentIndex: int):
+            groupIndex = obj.vertexGroups.get(bone.name)
+            bones.append(
+                {
+                    "name": bone.name,
+                    "parent": parentIndex,
+                    "group": groupIndex + 1 if groupIndex is not None else None,
+                }
+            )
+            boneIndex = len(bones)
+            for child in bone.children:
+                addBone(child, boneIndex)
+
+        for bone in obj.bones:
+            addBone(bone, 0)
 
         meshData = {
             "modelName": name,
@@ -617,44 +1573,113 @@ def generateAvatar(name: str, obj: Object):
                 for groupName, groupIndex in obj.vertexGroups.items()
             },
             "textureMap": [texture.name for texture in obj.textures],
-            "vertexData": [
+            "bones": bones,
+        }
+        if weightPalettes:
+            # @type [palette:{group:weight}]
+            meshData["palettes"] = [
                 {
-                    "loops": generateLoopIndices(index),
+                    paletteGroups[i] + 1: paletteWeights[i]
+                    for i in range(paletteOffsets[palette], paletteOffsets[palette + 1])
+                }
+                for palette in range(len(paletteOffsets) - 1)
+            ]
+        if meshDataFormat == "PACKED":
+            meshData["vertexCount"] = mesh.vertexCount
+            meshData["packedVertexData"] = packVertexData()
+        elif meshDataFormat == "DENSE":
+            # Flat arrays, see the driver. Vertex v uses the entries starts[v] .. starts[v + 1] - 1
+            refVertices = mesh.loopVertices[np.concatenate(figuraVertexMap)]
+            order = np.argsort(refVertices, kind="stable")
+            vertexRefStarts = np.ones(mesh.vertexCount + 1, dtype=np.int64)
+            np.cumsum(
+                np.bincount(refVertices, minlength=mesh.vertexCount),
+                out=vertexRefStarts[1:],
+            )
+            vertexRefStarts[1:] += 1
+            meshData["vertexCount"] = mesh.vertexCount
+            meshData["vertexRefStarts"] = vertexRefStarts.tolist()
+            meshData["refTextures"] = (
+                np.repeat(
+                    np.arange(1, len(figuraVertexMap) + 1),
+                    [len(loops) for loops in figuraVertexMap],
+                )[order].tolist()
+            )
+            meshData["refVertices"] = (
+                np.concatenate(
+                    [np.arange(1, len(loops) + 1) for loops in figuraVertexMap]
+                )[order].tolist()
+            )
+            meshData["restPositions"] = np.round(
+                mesh.positions.astype(np.float64), 4
+            ).ravel().tolist()
+            groupBones = np.zeros(len(obj.vertexGroups) + 1, dtype=np.int64)
+            for boneIndex, bone in enumerate(bones):
+                if bone["group"] is not None:
+                    groupBones[bone["group"] - 1] = boneIndex + 1
+            # Bone b moves the vertices boneVertexList[boneVertexStarts[b] .. boneVertexStarts[b + 1] - 1]
+            influenceBones = groupBones[mesh.weightGroups]
+            hasBone = influenceBones > 0
+            boneVertices = mesh.influenceVertices()[hasBone]
+            influenceBones = influenceBones[hasBone]
+            order = np.lexsort((boneVertices, influenceBones))
+            boneVertexStarts = np.ones(len(bones) + 1, dtype=np.int64)
+            np.cumsum(
+                np.bincount(influenceBones, minlength=len(bones) + 1)[1:],
+                out=boneVertexStarts[1:],
+            )
+            boneVertexStarts[1:] += 1
+            meshData["boneVertexStarts"] = boneVertexStarts.tolist()
+            meshData["boneVertexList"] = (boneVertices[order] + 1).tolist()
+            if weightPalettes:
+                meshData["vertexPalettes"] = [palette + 1 for palette in vertexPalettes]
+            else:
+                meshData["influenceStarts"] = (mesh.weightOffsets + 1).tolist()
+                meshData["influenceBones"] = groupBones[mesh.weightGroups].tolist()
+                meshData["influenceWeights"] = weightValues
+        else:
+            # @type {group:[vertices weighted to that group]}. Packed data leaves this to the driver
+            influenceVertices = mesh.influenceVertices()
+            order = np.argsort(mesh.weightGroups, kind="stable")
+            groups, starts = np.unique(mesh.weightGroups[order], return_index=True)
+            meshData["boneVertices"] = {
+                group + 1: (vertices + 1).tolist()
+                for group, vertices in zip(
+                    groups.tolist(), np.split(influenceVertices[order], starts[1:])
+                )
+            }
+            # @type [vertex:[x, y, z]]
+            restPositions = np.round(mesh.positions.astype(np.float64), 4).tolist()
+            meshData["vertexData"] = (
+                {
+                    "loops": vertexLoopIndices[index],
+                    "rest": restPositions[index],
+                    "palette": vertexPalettes[index] + 1,
+                }
+                if weightPalettes
+                else {
+                    "loops": vertexLoopIndices[index],
+                    "rest": restPositions[index],
                     "weights": {
-                        group + 1: round(weight, 4)
-                        for group, weight in vertex.weights.items()
+                        weightGroups[i] + 1: weightValues[i]
+                        for i in range(weightOffsets[index], weightOffsets[index + 1])
                     }
-                    if len(vertex.weights) != 0
+                    if weightOffsets[index] != weightOffsets[index + 1]
                     else None,
                 }
-                for index, vertex in enumerate(obj.mesh.vertices)
-            ],
-        }
-
-        allBones = []
-
-        def allBonesRecursive(bone):
-            allBones.append(bone)
-            for b in bone.children:
-                allBonesRecursive(b)
-
-        for b in obj.bones:
-            allBonesRecursive(b)
-
-        missingGroups = [
-            bone for bone in allBones if bone.name not in meshData["groupMap"].keys()
-        ]
-        lastGroupIndex=len(obj.vertexGroups)
-        for i, group in enumerate(missingGroups):
-            meshData["groupMap"][group.name] = lastGroupIndex+i+1
+                for index in range(mesh.vertexCount)
+            )
 
-        return "return " + LuaParser.toLua(meshData)
+        return meshData
 
-    return (generateBBModel(obj), generateMeshData(name, obj))
+    return (
+        generateBBModel(obj),
+        generateMeshData(name, obj, meshDataFormat, weightPalettes),
+    )
 
 
 class ExportFiguraAvatar(BlOperator, ExportHelper):
-    from bpy.props import BoolProperty, StringProperty
+    from bpy.props import BoolProperty, EnumProperty, IntProperty, StringProperty
 
     """Exports the currently seleted mesh as a Figura Avatar"""  # Use this as a tooltip for menu items and buttons.
     bl_idname = "export.figura_avatar"  # Unique identifier for buttons and menu items to reference.
@@ -669,6 +1694,60 @@ class ExportFiguraAvatar(BlOperator, ExportHelper):
     )
 
     export_with_driver: BoolProperty(name="Export with driver code")
+    mesh_data_format: EnumProperty(
+        name="Mesh data format",
+        items=(
+            ("TABLE", "Lua Tables", "Every vertex is a Lua table literal"),
+            (
+                "PACKED",
+                "Packed Binary",
+                "Vertex data is packed into a base64 string and decoded on init. Much smaller",
+            ),
+            (
+                "DENSE",
+                "Flat Arrays",
+                "Vertex data is split into flat lists of numbers. Fastest to load and smallest in memory",
+            ),
+        ),
+        default="TABLE",
+    )
+    merge_solid_colors: BoolProperty(
+        name="Merge solid colours",
+        description="Materials without an image share one small palette texture instead of a texture each",
+    )
+    crop_textures: BoolProperty(
+        name="Crop textures",
+        description="Cut away the parts of every texture that no UVs use",
+    )
+    crop_padding: IntProperty(
+        name="Crop padding",
+        description="Pixels kept around the used area of cropped textures",
+        default=1,
+        min=0,
+    )
+    pack_atlas: BoolProperty(
+        name="Pack textures into an atlas",
+        description="All materials share a single texture. The driver has fewer vertex lists to go through and the avatar gets smaller",
+    )
+    recompress_textures: BoolProperty(
+        name="Recompress textures",
+        description="Make the embedded textures smaller without changing a single pixel. Float and 16 bit image files are kept as they are. Takes a moment for big textures",
+    )
+    split_rigid_parts: BoolProperty(
+        name="Split rigid parts",
+        description="Faces moved entirely by a single bone are exported inside that bone's group instead of the deformed mesh, so the driver does not need to move them",
+    )
+    weight_palettes: BoolProperty(
+        name="Share weight palettes",
+        description="Vertices with the same bone weights share one blended matrix in the driver. Weights are rounded to 1/255",
+    )
+    max_influences: IntProperty(
+        name="Max bone influences",
+        description="Keep only the strongest bone weights of every vertex and renormalize them. 0 keeps every weight",
+        default=0,
+        min=0,
+        max=4,
+    )
 
     def execute(self, context):
         meshObj = context.active_object
@@ -686,13 +1765,50 @@ class ExportFiguraAvatar(BlOperator, ExportHelper):
 
         directory, file = os.path.split(self.filepath)
         filename, _ = os.path.splitext(file)
-        bbmodel, meshdata = generateAvatar(filename, Object.parseObject(meshObj))
+        obj = Object.parseObject(meshObj)
+        # the driver ignores groups without a bone, so they must not take up influences
+        obj.mesh = obj.mesh.normalizeWeights(obj.groupIsBone())
+        if self.max_influences != 0:
+            limitedMesh = obj.mesh.limitInfluences(self.max_influences)
+            poseMatrices = Object.parsePoseMatrices(meshObj)
+            error = np.linalg.norm(
+                limitedMesh.skin(poseMatrices) - obj.mesh.skin(poseMatrices), axis=1
+            )
+            self.report(
+                {"INFO"},
+                f"Limited vertices to {self.max_influences} bone influences. Max positional error in the current pose: {error.max(initial=0):.4f}",
+            )
+            obj.mesh = limitedMesh
+        parsedTextures = list(obj.textures)
+        if self.merge_solid_colors:
+            obj.mergeSolidColors()
+        if self.crop_textures:
+            obj.cropTextures(self.crop_padding)
+        if self.pack_atlas:
+            obj.packAtlas()
+        if self.recompress_textures:
+            obj.textures = Texture.optimizeTextures(obj.textures)
+        Texture.pruneCache(parsedTextures + obj.textures)
+        if self.split_rigid_parts:
+            obj.splitRigidParts()
+        bbmodel, meshdata = generateAvatar(
+            filename,
+            obj,
+            meshDataFormat=self.mesh_data_format,
+            weightPalettes=self.weight_palettes,
+        )
+        if self.weight_palettes:
+            self.report(
+                {"INFO"},
+                f"{obj.mesh.vertexCount} vertices share {len(meshdata['palettes'])} weight palettes",
+            )
 
         with open(os.path.join(directory, f"{filename}.bbmodel"), "w") as file:
-            file.write(bbmodel)
+            JsonParser.writeJson(bbmodel, file)
 
         with open(os.path.join(directory, f"{filename}-MeshData.lua"), "w") as file:
-            file.write(meshdata)
+            file.write("return ")
+            LuaParser.writeLua(meshdata, file)
 
         if self.export_with_driver:
             import shutil
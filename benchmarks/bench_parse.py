@@ -0,0 +1,55 @@
+# Times Mesh.parseMesh on grid meshes of 1k, 10k and 100k faces.
+# Run from the repository root with:
+#   blender -b -P benchmarks/bench_parse.py
+import bpy, math, os, time, importlib.util
+
+addonPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "__init__.py")
+spec = importlib.util.spec_from_file_location("figura_avatar_export", addonPath)
+addon = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(addon)
+
+
+# side x side quads, weighted to 4 bones that blend across the grid like a limb
+def makeGrid(faceCount: int) -> bpy.types.Object:
+    side = round(math.sqrt(faceCount))
+    vertices = [(x, y, 0) for y in range(side + 1) for x in range(side + 1)]
+    faces = [
+        (
+            y * (side + 1) + x,
+            y * (side + 1) + x + 1,
+            (y + 1) * (side + 1) + x + 1,
+            (y + 1) * (side + 1) + x,
+        )
+        for y in range(side)
+        for x in range(side)
+    ]
+    mesh = bpy.data.meshes.new(f"grid_{faceCount}")
+    mesh.from_pydata(vertices, [], faces)
+    mesh.uv_layers.new()
+    obj = bpy.data.objects.new(mesh.name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+
+    groups = [obj.vertex_groups.new(name=f"bone{i}") for i in range(4)]
+    for index, (x, _, _) in enumerate(vertices):
+        position = x / side * (len(groups) - 1)
+        bone = min(int(position), len(groups) - 2)
+        blend = position - bone
+        groups[bone].add([index], 1 - blend, "REPLACE")
+        if blend > 0:
+            groups[bone + 1].add([index], blend, "REPLACE")
+    return obj
+
+
+print(f"{'faces':>8} {'loops':>8} {'parseMesh':>10}")
+for faceCount in (1_000, 10_000, 100_000):
+    obj = makeGrid(faceCount)
+    # best of 3, the first run also pays for filling Blender's caches
+    best = math.inf
+    for _ in range(3):
+        start = time.perf_counter()
+        addon.Mesh.parseMesh(obj.data)
+        best = min(best, time.perf_counter() - start)
+    print(f"{len(obj.data.polygons):>8} {len(obj.data.loops):>8} {best * 1000:>8.1f}ms")
+    mesh = obj.data
+    bpy.data.objects.remove(obj)
+    bpy.data.meshes.remove(mesh)